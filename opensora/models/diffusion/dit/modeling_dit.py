@@ -10,7 +10,6 @@ from typing import Final, Optional, Tuple, Union
 
 import torch
 import torch.nn as nn
-import numpy as np
 import torch.utils.checkpoint as cp
 from torch.nn import functional as F
 from einops import rearrange, repeat
@@ -30,6 +29,7 @@ try:
 except:
     RING_ATTENTION_IS_AVAILABLE = False
 
+from ..pos_embed import get_1d_sincos_temp_embed, get_2d_sincos_pos_embed
 from .VisionRoPE import VisionRotaryEmbeddingFast
 from .configuration_dit import DiTConfiguration
 
@@ -114,9 +114,6 @@ class Attention(nn.Module):
                 attn_bias = self.make_attn_bias(attn_mask)
                 attn = attn + attn_bias
             attn = attn.softmax(dim=-1)
-            if torch.any(torch.isnan(attn)):
-                print('torch.any(torch.isnan(attn))')
-                attn = attn.masked_fill(torch.isnan(attn), float(0.))
             attn = self.attn_drop(attn)
             x = (attn @ v).transpose(1, 2).reshape(B, N, C)
 
@@ -334,11 +331,13 @@ class DiT(nn.Module):
         self.apply(_basic_init)
 
         # Initialize (and freeze) pos_embed by sin-cos embedding:
-        pos_embed = get_2d_sincos_pos_embed(self.pos_embed.shape[-1], int(self.x_embedder.num_patches ** 0.5))
-        self.pos_embed.data.copy_(torch.from_numpy(pos_embed).float().unsqueeze(0))
+        pos_embed = get_2d_sincos_pos_embed(self.pos_embed.shape[-1], int(self.x_embedder.num_patches ** 0.5),
+                                            device=self.pos_embed.device)
+        self.pos_embed.data.copy_(pos_embed.unsqueeze(0))
 
-        temp_embed = get_1d_sincos_temp_embed(self.temp_embed.shape[-1], self.temp_embed.shape[-2])
-        self.temp_embed.data.copy_(torch.from_numpy(temp_embed).float().unsqueeze(0))
+        temp_embed = get_1d_sincos_temp_embed(self.temp_embed.shape[-1], self.temp_embed.shape[-2],
+                                              device=self.temp_embed.device)
+        self.temp_embed.data.copy_(temp_embed.unsqueeze(0))
 
         # Initialize patch_embed like nn.Linear (instead of nn.Conv2d):
         w = self.x_embedder.proj.weight.data
@@ -453,66 +452,6 @@ class DiT(nn.Module):
         return torch.cat([eps, rest], dim=1)
 
 
-#################################################################################
-#                   Sine/Cosine Positional Embedding Functions                  #
-#################################################################################
-# https://github.com/facebookresearch/mae/blob/main/util/pos_embed.py
-
-def get_1d_sincos_temp_embed(embed_dim, length):
-    pos = torch.arange(0, length).unsqueeze(1)
-    return get_1d_sincos_pos_embed_from_grid(embed_dim, pos)
-
-def get_2d_sincos_pos_embed(embed_dim, grid_size, cls_token=False, extra_tokens=0):
-    """
-    grid_size: int of the grid height and width
-    return:
-    pos_embed: [grid_size*grid_size, embed_dim] or [1+grid_size*grid_size, embed_dim] (w/ or w/o cls_token)
-    """
-    grid_h = np.arange(grid_size, dtype=np.float32)
-    grid_w = np.arange(grid_size, dtype=np.float32)
-    grid = np.meshgrid(grid_w, grid_h)  # here w goes first
-    grid = np.stack(grid, axis=0)
-
-    grid = grid.reshape([2, 1, grid_size, grid_size])
-    pos_embed = get_2d_sincos_pos_embed_from_grid(embed_dim, grid)
-    if cls_token and extra_tokens > 0:
-        pos_embed = np.concatenate([np.zeros([extra_tokens, embed_dim]), pos_embed], axis=0)
-    return pos_embed
-
-
-def get_2d_sincos_pos_embed_from_grid(embed_dim, grid):
-    assert embed_dim % 2 == 0
-
-    # use half of dimensions to encode grid_h
-    emb_h = get_1d_sincos_pos_embed_from_grid(embed_dim // 2, grid[0])
-    emb_w = get_1d_sincos_pos_embed_from_grid(embed_dim // 2, grid[1])
-
-    emb = np.concatenate([emb_h, emb_w], axis=1)
-    return emb
-
-
-def get_1d_sincos_pos_embed_from_grid(embed_dim, pos):
-    """
-    embed_dim: output dimension for each position
-    pos: a list of positions to be encoded: size (M,)
-    out: (M, D)
-    """
-    assert embed_dim % 2 == 0
-    omega = np.arange(embed_dim // 2, dtype=np.float64)
-    omega /= embed_dim / 2.
-    omega = 1. / 10000**omega
-
-    pos = pos.reshape(-1)
-    out = np.einsum('m,d->md', pos, omega)
-
-    emb_sin = np.sin(out)
-    emb_cos = np.cos(out)
-
-    emb = np.concatenate([emb_sin, emb_cos], axis=1)
-    return emb
-
-
-
 #################################################################################
 #                                   DiT Configs                                  #
 #################################################################################
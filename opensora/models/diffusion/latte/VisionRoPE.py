@@ -77,13 +77,39 @@ class VisionRotaryEmbeddingFast(nn.Module):
         freqs_cos = freqs.cos().view(-1, freqs.shape[-1])
         freqs_sin = freqs.sin().view(-1, freqs.shape[-1])
 
-        self.register_buffer("freqs_cos", freqs_cos)
-        self.register_buffer("freqs_sin", freqs_sin)
+        # the tables are fully determined by the arguments above, no need to keep them in checkpoints
+        self.register_buffer("freqs_cos", freqs_cos, persistent=False)
+        self.register_buffer("freqs_sin", freqs_sin, persistent=False)
+        self._cos_sin_cache = {}
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # checkpoints saved before the tables became non-persistent still carry them
+        state_dict.pop(prefix + 'freqs_cos', None)
+        state_dict.pop(prefix + 'freqs_sin', None)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def _apply(self, fn, *args, **kwargs):
+        super()._apply(fn, *args, **kwargs)
+        # .to() / .half() replace the tables, casts of the old ones are stale
+        self._cos_sin_cache.clear()
+        return self
+
+    def get_cos_sin(self, dtype):
+        # cast the tables once per (dtype, device) instead of promoting activations to fp32 on every call
+        key = (dtype, self.freqs_cos.device)
+        if key in self._cos_sin_cache:
+            return self._cos_sin_cache[key]
+        cos_sin = (self.freqs_cos.to(dtype), self.freqs_sin.to(dtype))
+        # casts made under inference_mode are inference tensors, which autograd can't save for
+        # backward, so they are only used for this call and not kept for later ones
+        if not torch.is_inference_mode_enabled():
+            self._cos_sin_cache[key] = cos_sin
+        return cos_sin
 
     def forward(self, t):
         # 2d RoPE: [[cos(h*theta), -sin(h*theta), 0,            0            ],
         #           [sin(h*theta), cos(h*theta),  0,            0            ],
         #           [0,            0,             cos(w*theta), -sin(w*theta)],
         #           [0,            0,             sin(w*theta), cos(w*theta) ],]
-
-        return t * self.freqs_cos + rotate_half(t) * self.freqs_sin
\ No newline at end of file
+        freqs_cos, freqs_sin = self.get_cos_sin(t.dtype)
+        return t * freqs_cos + rotate_half(t) * freqs_sin
@@ -19,12 +19,13 @@ class LatteConfiguration:
         num_classes=1000,
         learn_sigma=True,
         extras=1,
-        attention_mode='math',
+        attention_mode='flash',
         compress_kv=False,
         attention_pe_mode=None,
         pt_input_size: Union[int, Tuple[int, int]] = None,  # (h, w)
         pt_num_frames: Union[int, Tuple[int, int]] = None,  # (num_frames, 1)
         intp_vfreq: bool = True,  # vision position interpolation
+        bf16_autocast: bool = False,  # run forward under bf16 autocast when the caller has none
         **kwargs,
     ):
         super().__init__(**kwargs)
@@ -48,6 +49,7 @@ class LatteConfiguration:
         self.pt_input_size = pt_input_size
         self.pt_num_frames = pt_num_frames
         self.intp_vfreq = intp_vfreq
+        self.bf16_autocast = bf16_autocast
 
     def to_json_string(self):
         json_string = json.dumps(vars(self))
@@ -123,9 +123,6 @@ class Attention(nn.Module):
                 attn_bias = self.make_attn_bias(attn_mask)
                 attn = attn + attn_bias
             attn = attn.softmax(dim=-1)
-            if torch.any(torch.isnan(attn)):
-                print('torch.any(torch.isnan(attn))')
-                attn = attn.masked_fill(torch.isnan(attn), float(0.))
             attn = self.attn_drop(attn)
             x = (attn @ v).transpose(1, 2).reshape(B, N, C)
 
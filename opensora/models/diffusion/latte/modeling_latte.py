@@ -8,17 +8,18 @@
 # MAE: https://github.com/facebookresearch/mae/blob/main/models_mae.py
 # --------------------------------------------------------
 import math
+import types
+import functools
 
 import torch
 import torch.nn as nn
 import torch.utils.checkpoint as cp
-import numpy as np
 from torch.nn import functional as F
-from einops import rearrange, repeat
-from typing import Tuple, Union
+from typing import Optional, Tuple, Union
 from timm.layers import to_2tuple
 from timm.models.vision_transformer import Mlp, PatchEmbed
 
+from ..pos_embed import get_1d_sincos_temp_embed, get_2d_sincos_pos_embed
 from .VisionRoPE import VisionRotaryEmbeddingFast
 
 try:
@@ -33,13 +34,21 @@ try:
 except:
     RING_ATTENTION_IS_AVAILABLE = False
 
+try:
+    # needs to have https://github.com/Dao-AILab/flash-attention installed
+    from flash_attn import flash_attn_varlen_func
+    FLASH_ATTN_IS_AVAILABLE = True
+except:
+    FLASH_ATTN_IS_AVAILABLE = False
+
 from .configuration_latte import LatteConfiguration
 
 # from timm.models.layers.helpers import to_2tuple
 # from timm.models.layers.trace_utils import _assert
 
 def modulate(x, shift, scale):
-    return x * (1 + scale.unsqueeze(1)) + shift.unsqueeze(1)
+    # shift, scale broadcast over the token dims of x, x * (1 + scale) + shift as a single fused op
+    return torch.addcmul(shift, x, 1 + scale)
 
 #################################################################################
 #               Attention Layers from TIMM                                      #
@@ -53,7 +62,7 @@ class Attention(nn.Module):
                  attn_drop=0.,
                  proj_drop=0.,
                  use_lora=False,
-                 attention_mode='math',
+                 attention_mode='flash',
                  eps=1e-12,
                  causal=True,
                  ring_bucket_size=1024,
@@ -61,7 +70,8 @@ class Attention(nn.Module):
                  hw: Union[int, Tuple[int, int]] = 16,  # (h, w)
                  pt_hw: Union[int, Tuple[int, int]] = 16,  # (h, w)
                  intp_vfreq: bool = True,  # vision position interpolation
-                 compress_kv: bool = False
+                 compress_kv: bool = False,
+                 rope_cache: Optional[dict] = None,  # shared between the attentions of one model
                  ):
         super().__init__()
         assert dim % num_heads == 0, 'dim should be divisible by num_heads'
@@ -82,43 +92,60 @@ class Attention(nn.Module):
         if self.attention_pe_mode == '2d_rope':
             half_head_dim = dim // num_heads // 2
             self.hw = to_2tuple(hw)
-            self.rope = VisionRotaryEmbeddingFast(
+            rope_kwargs = dict(
                 dim=half_head_dim,
                 pt_hw=to_2tuple(pt_hw),
                 ft_hw=self.hw if intp_vfreq else None,
             )
-
-    def forward(self, x, attn_mask):
+            if rope_cache is None:
+                self.rope = VisionRotaryEmbeddingFast(**rope_kwargs)
+            else:
+                # the sin/cos tables only depend on these arguments, so attentions with the same grid
+                # share one module (and its buffers / dtype casts) instead of each holding a copy
+                key = tuple(rope_kwargs.values())
+                if key not in rope_cache:
+                    rope_cache[key] = VisionRotaryEmbeddingFast(**rope_kwargs)
+                self.rope = rope_cache[key]
+
+    def forward(self, x, attn_mask, varlen_meta=None):
         B, N, C = x.shape
-        qkv = self.qkv(x).reshape(B, N, 3, self.num_heads, C // self.num_heads).permute(2, 0, 3, 1, 4).contiguous()
-        q, k, v = qkv.unbind(0)   # make torchscript happy (cannot use tensor as tuple) b h n c
+        qkv = self.qkv(x).view(B, N, 3, self.num_heads, C // self.num_heads)
+        q, k, v = [t.transpose(1, 2) for t in qkv.unbind(2)]  # b h n c, strided views of qkv
         if attn_mask is not None:
-            attn_mask = attn_mask.repeat(1, self.num_heads, 1, 1).to(q.dtype)
+            attn_mask = attn_mask.to(q.dtype)  # b 1 n n, broadcast over heads
 
         if self.attention_pe_mode == '2d_rope':
-            q_t = q.view(B, self.num_heads, -1, self.hw[0] * self.hw[1], C // self.num_heads)
-            ro_q_t = self.rope(q_t)
-            q = ro_q_t.view(B, self.num_heads, N, C // self.num_heads)
-
-            k_t = k.view(B, self.num_heads, -1, self.hw[0] * self.hw[1], C // self.num_heads)
-            ro_k_t = self.rope(k_t)
-            k = ro_k_t.view(B, self.num_heads, N, C // self.num_heads)
+            # q and k sit next to each other in qkv, rotate both in one pass over a strided view of it
+            qk_t = qkv[:, :, :2].permute(2, 0, 3, 1, 4)  # b n 2 h c -> 2 b h n c
+            qk_t = qk_t.unflatten(3, (-1, self.hw[0] * self.hw[1]))  # 2 b h t (h w) c
+            q, k = self.rope(qk_t).flatten(3, 4).unbind(0)
 
         if self.attention_mode == 'xformers':  # require pytorch 2.0
+            attn_bias = self.make_attn_bias(attn_mask) if attn_mask is not None else None
             with torch.backends.cuda.sdp_kernel(enable_math=False, enable_flash=False, enable_mem_efficient=True):
-                x = F.scaled_dot_product_attention(q, k, v, attn_mask=attn_mask,
-                                                   dropout_p=self.attn_drop.p, scale=self.scale).reshape(B, N, C)
+                x = F.scaled_dot_product_attention(q, k, v, attn_mask=attn_bias,
+                                                   dropout_p=self.attn_drop.p if self.training else 0., scale=self.scale)
+            x = x.transpose(1, 2).reshape(B, N, C)
+
+        elif self.attention_mode == 'flash' and varlen_meta is not None:  # require flash-attn, padded batch
+            # only the kept tokens are packed and attended, padded tokens get zeros
+            indices, cu_seqlens, max_seqlen = varlen_meta
+            x = q.new_zeros(B * N, self.num_heads, C // self.num_heads)
+            if max_seqlen > 0:  # else every token is padding and there is nothing to attend
+                q, k, v = [t.transpose(1, 2).reshape(B * N, self.num_heads, -1).index_select(0, indices) for t in (q, k, v)]
+                out = flash_attn_varlen_func(q, k, v, cu_seqlens, cu_seqlens, max_seqlen, max_seqlen,
+                                             dropout_p=self.attn_drop.p if self.training else 0., softmax_scale=self.scale)
+                x = x.index_copy(0, indices, out)
+            x = x.view(B, N, C)
 
         elif self.attention_mode == 'flash':  # require pytorch 2.0
             # https://github.com/PKU-YuanGroup/Open-Sora-Plan/issues/109
-            if attn_mask is None or torch.all(attn_mask.bool()):
-                with torch.backends.cuda.sdp_kernel(enable_math=False, enable_flash=True, enable_mem_efficient=False):
-                    x = F.scaled_dot_product_attention(q, k, v,
-                                                       dropout_p=self.attn_drop.p, scale=self.scale).reshape(B, N, C)
-            else:  # turn to xformers
-                with torch.backends.cuda.sdp_kernel(enable_math=False, enable_flash=False, enable_mem_efficient=True):
-                    x = F.scaled_dot_product_attention(q, k, v, attn_mask=attn_mask,
-                                                       dropout_p=self.attn_drop.p, scale=self.scale).reshape(B, N, C)
+            # flash kernel does not take a mask, sdpa falls back to mem-efficient one when a mask is given
+            attn_bias = self.make_attn_bias(attn_mask) if attn_mask is not None else None
+            with torch.backends.cuda.sdp_kernel(enable_math=False, enable_flash=True, enable_mem_efficient=True):
+                x = F.scaled_dot_product_attention(q, k, v, attn_mask=attn_bias,
+                                                   dropout_p=self.attn_drop.p if self.training else 0., scale=self.scale)
+            x = x.transpose(1, 2).reshape(B, N, C)
 
         elif self.attention_mode == 'math':
             attn = (q @ k.transpose(-2, -1)) * self.scale
@@ -126,16 +153,16 @@ class Attention(nn.Module):
                 attn_bias = self.make_attn_bias(attn_mask)
                 attn = attn + attn_bias
             attn = attn.softmax(dim=-1)
-            if torch.any(torch.isnan(attn)):
-                print('torch.any(torch.isnan(attn))')
-                attn = attn.masked_fill(torch.isnan(attn), float(0.))
             attn = self.attn_drop(attn)
             x = (attn @ v).transpose(1, 2).reshape(B, N, C)
 
         elif self.attention_mode == 'rebased':
+            # the triton kernel indexes raw strides, so only this path materializes q, k, v
+            q, k, v = q.contiguous(), k.contiguous(), v.contiguous()
             x = parallel_rebased(q, k, v, self.eps, True, True).reshape(B, N, C)
 
         elif self.attention_mode == 'ring':
+            q, k, v = q.contiguous(), k.contiguous(), v.contiguous()
             x = ring_flash_attn_cuda(q, k, v, causal=self.causal, bucket_size=self.ring_bucket_size).reshape(B, N, C)
 
         else:
@@ -148,8 +175,8 @@ class Attention(nn.Module):
     def make_attn_bias(self, attn_mask):
         # The numerical range of bfloat16, float16 can't conver -1e8
         # Refer to https://discuss.pytorch.org/t/runtimeerror-value-cannot-be-converted-to-type-at-half-without-overflow-1e-30/109768
-        attn_bias = torch.where(attn_mask == 0, -1e8 if attn_mask.dtype == torch.float32 else -1e4, attn_mask)
-        attn_bias = torch.where(attn_mask == 1, 0., attn_bias)
+        # attn_mask holds 0/1, so a single pass maps 1 -> 0 and 0 -> -1e8 (-1e4)
+        attn_bias = (attn_mask - 1) * (1e8 if attn_mask.dtype == torch.float32 else 1e4)
         return attn_bias
 
 
@@ -311,30 +338,43 @@ class TimestepEmbedder(nn.Module):
             nn.Linear(hidden_size, hidden_size, bias=True),
         )
         self.frequency_embedding_size = frequency_embedding_size
+        self.register_buffer('freqs', self.make_freqs(frequency_embedding_size), persistent=False)
 
     @staticmethod
-    def timestep_embedding(t, dim, max_period=10000):
+    def make_freqs(dim, max_period=10000, device=None):
+        """
+        :param dim: the dimension of the embeddings.
+        :param max_period: controls the minimum frequency of the embeddings.
+        :return: a (dim // 2,) fp32 Tensor of frequencies.
+        """
+        # https://github.com/openai/glide-text2im/blob/main/glide_text2im/nn.py
+        half = dim // 2
+        return torch.exp(
+            -math.log(max_period) * torch.arange(start=0, end=half, dtype=torch.float32, device=device) / half
+        )
+
+    def _apply(self, fn, *args, **kwargs):
+        super()._apply(fn, *args, **kwargs)
+        # .half() / .bfloat16() on the model casts buffers as well, the table has to stay in fp32
+        if self.freqs.dtype != torch.float32:
+            self.freqs = self.make_freqs(self.frequency_embedding_size, device=self.freqs.device)
+        return self
+
+    def timestep_embedding(self, t):
         """
         Create sinusoidal timestep embeddings.
         :param t: a 1-D Tensor of N indices, one per batch element.
                           These may be fractional.
-        :param dim: the dimension of the output.
-        :param max_period: controls the minimum frequency of the embeddings.
         :return: an (N, D) Tensor of positional embeddings.
         """
-        # https://github.com/openai/glide-text2im/blob/main/glide_text2im/nn.py
-        half = dim // 2
-        freqs = torch.exp(
-            -math.log(max_period) * torch.arange(start=0, end=half, dtype=torch.float32) / half
-        ).to(device=t.device)
-        args = t[:, None].float() * freqs[None]
+        args = t[:, None].float() * self.freqs[None]
         embedding = torch.cat([torch.cos(args), torch.sin(args)], dim=-1)
-        if dim % 2:
+        if self.frequency_embedding_size % 2:
             embedding = torch.cat([embedding, torch.zeros_like(embedding[:, :1])], dim=-1)
         return embedding
 
     def forward(self, t):
-        t_freq = self.timestep_embedding(t, self.frequency_embedding_size)
+        t_freq = self.timestep_embedding(t)
         t_emb = self.mlp(t_freq)
         return t_emb
 
@@ -390,11 +430,16 @@ class TransformerBlock(nn.Module):
             nn.Linear(hidden_size, 6 * hidden_size, bias=True)
         )
 
-    def forward(self, x, c, attn_bias):
-        shift_msa, scale_msa, gate_msa, shift_mlp, scale_mlp, gate_mlp = self.adaLN_modulation(c).chunk(6, dim=1)
-        x = x + gate_msa.unsqueeze(1) * self.attn(modulate(self.norm1(x), shift_msa, scale_msa), attn_bias)
-        x = x + gate_mlp.unsqueeze(1) * self.mlp(modulate(self.norm2(x), shift_mlp, scale_mlp))
-        return x
+    def forward(self, x, c, attn_bias, varlen_meta=None):
+        # c: (B, C), one row per sample; x: ((B * R), N, C), R frames or tokens per sample.
+        # The modulation is computed per sample and broadcast over its R rows.
+        B, C = c.shape
+        shift_msa, scale_msa, gate_msa, shift_mlp, scale_mlp, gate_mlp = self.adaLN_modulation(c).view(B, 1, 6, 1, C).unbind(2)
+        x = x.view(B, -1, *x.shape[1:])  # (b r) n c -> b r n c
+        attn_out = self.attn(modulate(self.norm1(x), shift_msa, scale_msa).flatten(0, 1), attn_bias, varlen_meta)
+        x = torch.addcmul(x, gate_msa, attn_out.view_as(x))
+        x = torch.addcmul(x, gate_mlp, self.mlp(modulate(self.norm2(x), shift_mlp, scale_mlp)))
+        return x.flatten(0, 1)
 
 
 class FinalLayer(nn.Module):
@@ -411,16 +456,20 @@ class FinalLayer(nn.Module):
         )
 
     def forward(self, x, c):
-        shift, scale = self.adaLN_modulation(c).chunk(2, dim=1)
-        x = modulate(self.norm_final(x), shift, scale)
+        # c: (B, C), x: ((B * F), N, C), see TransformerBlock.forward
+        B, C = c.shape
+        shift, scale = self.adaLN_modulation(c).view(B, 1, 2, 1, C).unbind(2)
+        x = modulate(self.norm_final(x.view(B, -1, *x.shape[1:])), shift, scale)
         x = self.linear(x)
-        return x
+        return x.flatten(0, 1)
 
 
 class Latte(nn.Module):
     """
     Diffusion model with a Transformer backbone.
     """
+    max_cuda_graphs = 4  # see forward_graph
+
     def __init__(self, config: LatteConfiguration):
         super().__init__()
 
@@ -443,6 +492,7 @@ class Latte(nn.Module):
         pt_input_size = config.pt_input_size
         pt_num_frames = config.pt_num_frames
         intp_vfreq = config.intp_vfreq
+        bf16_autocast = config.bf16_autocast
 
         self.config = config
 
@@ -456,7 +506,9 @@ class Latte(nn.Module):
         self.num_frames = num_frames
         self.hidden_size = hidden_size
         self.compress_kv = compress_kv
+        self.bf16_autocast = bf16_autocast
         self.gradient_checkpointing = False
+        self.cuda_graphs = {}  # see forward_graph
 
         self.x_embedder = PatchEmbed(input_size, patch_size, in_channels, hidden_size, bias=True)
         self.t_embedder = TimestepEmbedder(hidden_size)
@@ -470,39 +522,55 @@ class Latte(nn.Module):
         )
 
         num_patches = self.x_embedder.num_patches
-        # Will use fixed sin-cos embedding:
-        self.pos_embed = nn.Parameter(torch.zeros(1, num_patches, hidden_size), requires_grad=False)
-        self.temp_embed = nn.Parameter(torch.zeros(1, num_frames, hidden_size), requires_grad=False)
+        # fixed sin-cos tables, not trained or saved
+        device = self.x_embedder.proj.weight.device
+        pos_embed = get_2d_sincos_pos_embed(hidden_size, int(num_patches ** 0.5), device=device)
+        temp_embed = get_1d_sincos_temp_embed(hidden_size, num_frames, device=device)
+        self.register_buffer('pos_embed', pos_embed.unsqueeze(0).clone(), persistent=False)
+        self.register_buffer('temp_embed', temp_embed.unsqueeze(0).clone(), persistent=False)
         self.hidden_size = hidden_size
 
         if pt_input_size is None:
             pt_input_size = input_size
         if pt_num_frames is None:
             pt_num_frames = num_frames
-        self.blocks = []
-        for i in range(depth):
-            if i % 2 == 0:
-                m = TransformerBlock(
-                    hidden_size, num_heads, mlp_ratio=mlp_ratio, attention_mode=attention_mode,
-                    attention_pe_mode=attention_pe_mode,
-                    hw=(input_size[0] // patch_size, input_size[1] // patch_size),
-                    pt_hw=(pt_input_size[0] // patch_size, pt_input_size[1] // patch_size),
-                    intp_vfreq=intp_vfreq, compress_kv=compress_kv
-                )
-            else:
-                m = TransformerBlock(
-                    hidden_size, num_heads, mlp_ratio=mlp_ratio, attention_mode=attention_mode,
-                    attention_pe_mode=attention_pe_mode,
-                    hw=(num_frames, 1),
-                    pt_hw=(pt_num_frames, 1),
-                    intp_vfreq=intp_vfreq, compress_kv=compress_kv
-                )
-            self.blocks.append(m)
-        self.blocks = nn.ModuleList(self.blocks)
+        spatial_hw = dict(
+            hw=(input_size[0] // patch_size, input_size[1] // patch_size),
+            pt_hw=(pt_input_size[0] // patch_size, pt_input_size[1] // patch_size),
+        )
+        temporal_hw = dict(hw=(num_frames, 1), pt_hw=(pt_num_frames, 1))
+        # scoped to this model, a module-level cache would tie the devices of separately built models together
+        rope_cache = {}
+        # even blocks attend over space, odd blocks over time
+        self.blocks = nn.ModuleList([
+            TransformerBlock(
+                hidden_size, num_heads, mlp_ratio=mlp_ratio, attention_mode=attention_mode,
+                attention_pe_mode=attention_pe_mode, intp_vfreq=intp_vfreq, compress_kv=compress_kv,
+                rope_cache=rope_cache, **(spatial_hw if i % 2 == 0 else temporal_hw)
+            ) for i in range(depth)
+        ])
 
         self.final_layer = FinalLayer(hidden_size, patch_size_t, patch_size, self.out_channels)
         self.initialize_weights()
 
+    def _apply(self, fn, *args, **kwargs):
+        # captured graphs replay into the old parameter / buffer memory, which .to() / .half() replace
+        self.cuda_graphs.clear()
+        return super()._apply(fn, *args, **kwargs)
+
+    def __getstate__(self):
+        # CUDA graphs can't be copied and belong to this instance's memory, so copies (the EMA
+        # deepcopy in train.py, pickling) start without them
+        state = self.__dict__.copy()
+        state['cuda_graphs'] = {}
+        return state
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # older checkpoints still store pos_embed / temp_embed
+        state_dict.pop(prefix + 'pos_embed', None)
+        state_dict.pop(prefix + 'temp_embed', None)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
     def initialize_weights(self):
         # Initialize transformer layers:
         def _basic_init(module):
@@ -512,13 +580,6 @@ class Latte(nn.Module):
                     nn.init.constant_(module.bias, 0)
         self.apply(_basic_init)
 
-        # Initialize (and freeze) pos_embed by sin-cos embedding:
-        pos_embed = get_2d_sincos_pos_embed(self.pos_embed.shape[-1], int(self.x_embedder.num_patches ** 0.5))
-        self.pos_embed.data.copy_(torch.from_numpy(pos_embed).float().unsqueeze(0))
-
-        temp_embed = get_1d_sincos_temp_embed(self.temp_embed.shape[-1], self.temp_embed.shape[-2])
-        self.temp_embed.data.copy_(torch.from_numpy(temp_embed).float().unsqueeze(0))
-
         # Initialize patch_embed like nn.Linear (instead of nn.Conv2d):
         w = self.x_embedder.proj.weight.data
         nn.init.xavier_uniform_(w.view([w.shape[0], -1]))
@@ -550,19 +611,45 @@ class Latte(nn.Module):
         """
         c = self.out_channels
         p = self.x_embedder.patch_size[0]
-        h = w = int(x.shape[1] ** 0.5)
+        h, w = self.x_embedder.grid_size
         assert h * w == x.shape[1]
 
         x = x.reshape(shape=(x.shape[0], h, w, p, p, c))
-        x = torch.einsum('nhwpqc->nchpwq', x)
-        imgs = x.reshape(shape=(x.shape[0], c, h * p, h * p))
+        x = x.permute(0, 5, 1, 3, 2, 4)  # nhwpqc -> nchpwq
+        imgs = x.reshape(shape=(x.shape[0], c, h * p, w * p))
         return imgs
 
-    def ckpt_wrapper(self, module):
-        def ckpt_forward(*inputs):
-            outputs = module(*inputs)
-            return outputs
-        return ckpt_forward
+    def block_pair_forward(self, spatial_block, temp_block, x, c,
+                           attention_mask_spatial, attention_mask_temproal,
+                           varlen_meta_spatial, varlen_meta_temproal, batches, add_temp_embed):
+        """
+        A spatial block followed by a temporal block.
+        x: ((N * F), T, D) in and out
+        """
+        _, tokens, dim = x.shape
+        frames = x.shape[0] // batches
+
+        x = spatial_block(x, c, attention_mask_spatial, varlen_meta_spatial)
+
+        x = x.view(batches, frames, tokens, dim).transpose(1, 2).reshape(batches * tokens, frames, dim)  # (b f) t d -> (b t) f d
+        # Add Time Embedding
+        if add_temp_embed:
+            x = x + self.temp_embed
+
+        x = temp_block(x, c, attention_mask_temproal, varlen_meta_temproal)
+        x = x.view(batches, tokens, frames, dim).transpose(1, 2).reshape(batches * frames, tokens, dim)  # (b t) f d -> (b f) t d
+        return x
+
+    def compile_blocks(self, **compile_kwargs):
+        """
+        torch.compile every transformer block on its own, so the norm/modulate/gate/residual
+        elementwise ops around the attention call get fused.
+        """
+        # compile the unbound forward and bind it per block, so a deepcopy (e.g. the EMA copy)
+        # rebinds it to the copied block instead of running the original's weights
+        compiled_forward = torch.compile(TransformerBlock.forward, **compile_kwargs)
+        for block in self.blocks:
+            block.forward = types.MethodType(compiled_forward, block)
 
     def make_mask(self, attention_mask):
         attention_mask = attention_mask.flatten(1).unsqueeze(-1)  # bs t h w -> bs thw 1
@@ -570,7 +657,21 @@ class Latte(nn.Module):
         attention_mask = attention_mask.unsqueeze(1)
         return attention_mask
 
-    # @torch.cuda.amp.autocast()
+    def make_varlen_meta(self, attention_mask):
+        # bs n 0/1 mask -> (indices of kept tokens in the flattened bs*n sequence, cu_seqlens, max_seqlen)
+        seqlens = attention_mask.sum(dim=1, dtype=torch.int32)
+        indices = torch.nonzero(attention_mask.flatten()).flatten()
+        # fully padded sequences (e.g. a pixel padded in every frame) hold no packed tokens, leave them
+        # out of cu_seqlens rather than handing the kernel zero-length sequences
+        seqlens = seqlens[seqlens > 0]
+        cu_seqlens = F.pad(torch.cumsum(seqlens, dim=0, dtype=torch.int32), (1, 0))
+        return indices, cu_seqlens, seqlens.max().item() if seqlens.numel() else 0
+
+    def use_varlen_attention(self, x):
+        # flash-attn kernels only run in fp16/bf16 on cuda
+        return (FLASH_ATTN_IS_AVAILABLE and self.config.attention_mode == 'flash' and x.is_cuda
+                and (x.dtype in (torch.float16, torch.bfloat16) or torch.is_autocast_enabled()))
+
     # @torch.compile
     def forward(self, 
                 x, 
@@ -585,75 +686,119 @@ class Latte(nn.Module):
         y: (N,) tensor of class labels
         attention_mask: (N, F, H, W)
         """
+        if self.bf16_autocast and x.is_cuda and not torch.is_autocast_enabled():
+            # linears and attention run in bf16, autocast keeps layernorm / softmax in fp32.
+            # An autocast opened by the caller (e.g. train.py --mixed-precision) is left alone.
+            with torch.autocast(device_type='cuda', dtype=torch.bfloat16):
+                x_out = self.forward(x, t, y=y, text_embedding=text_embedding, attention_mask=attention_mask)
+            return x_out.to(x.dtype)
+
         attention_mask_temproal, attention_mask_spatial = None, None
-        if attention_mask is not None:
-            attention_mask_spatial = rearrange(attention_mask, 'b t h w -> (b t) h w')
+        # an all-ones mask masks nothing, decide that once here (a single host sync) and let every
+        # block take the unmasked attention path instead of building and applying a no-op bias
+        if attention_mask is not None and attention_mask.all().item():
+            attention_mask = None
+        varlen_meta_spatial, varlen_meta_temproal = None, None
+        if attention_mask is not None and self.use_varlen_attention(x):
+            # pack the unpadded tokens for flash_attn_varlen_func instead of building n x n masks
+            varlen_meta_spatial = self.make_varlen_meta(attention_mask.flatten(0, 1).flatten(1))  # b t h w -> (b t) (h w)
+            varlen_meta_temproal = self.make_varlen_meta(attention_mask.permute(0, 2, 3, 1).flatten(0, 2))  # b t h w -> (b h w) t
+        elif attention_mask is not None:
+            attention_mask_spatial = attention_mask.flatten(0, 1)  # b t h w -> (b t) h w
             attention_mask_spatial = self.make_mask(attention_mask_spatial)
 
-            attention_mask_temproal = rearrange(attention_mask, 'b t h w -> (b h w) t')
+            attention_mask_temproal = attention_mask.permute(0, 2, 3, 1).flatten(0, 2)  # b t h w -> (b h w) t
             attention_mask_temproal = self.make_mask(attention_mask_temproal)
 
         batches, frames, channels, high, weight = x.shape
 
-        x = rearrange(x, 'b f c h w -> (b f) c h w')
+        x = x.reshape(batches * frames, channels, high, weight)  # b f c h w -> (b f) c h w
 
         x = self.x_embedder(x) + self.pos_embed
         t = self.t_embedder(t)
 
-
-        timestep_spatial = repeat(t, 'n d -> (n c) d', c=self.temp_embed.shape[1])
-        timestep_temp = repeat(t, 'n d -> (n c) d', c=self.pos_embed.shape[1])
-
+        # the conditioning is the same for every block, so add it only once. It is kept at one row
+        # per sample, the blocks broadcast their modulation over frames / tokens
         if self.extras == 2:
             y = self.y_embedder(y, self.training)
-            y_spatial = repeat(y, 'n d -> (n c) d', c=self.temp_embed.shape[1])
-            y_temp = repeat(y, 'n d -> (n c) d', c=self.pos_embed.shape[1])
+            c = t + y
         elif self.extras == 78:
             text_embedding = self.text_embedding_projection(text_embedding.reshape(batches, -1))
-            text_embedding_spatial = repeat(text_embedding, 'n d -> (n c) d', c=self.temp_embed.shape[1])
-            text_embedding_temp = repeat(text_embedding, 'n d -> (n c) d', c=self.pos_embed.shape[1])
-
-        for i in range(0, len(self.blocks), 2):
-            spatial_block, temp_block = self.blocks[i:i+2]
-            if self.extras == 2:
-                c = timestep_spatial + y_spatial
-            elif self.extras == 78:
-                c = timestep_spatial + text_embedding_spatial
-            else:
-                c = timestep_spatial
-            if self.gradient_checkpointing and self.training:
-                x = torch.utils.checkpoint.checkpoint(self.ckpt_wrapper(spatial_block), x, c, attention_mask_spatial)
-            else:
-                x = spatial_block(x, c, attention_mask_spatial)
-
-            x = rearrange(x, '(b f) t d -> (b t) f d', b=batches)
-            # Add Time Embedding
-            if i == 0:
-                x = x + self.temp_embed
-
-            if self.extras == 2:
-                c = timestep_temp + y_temp
-            elif self.extras == 78:
-                c = timestep_temp + text_embedding_temp
-            else:
-                c = timestep_temp
-
+            c = t + text_embedding
+        else:
+            c = t
+        # the final layer is conditioned on the timestep (and class label) only
+        c_final = t if self.extras == 78 else c
+
+        # walk the (spatial, temporal) pairs without slicing the ModuleList every iteration
+        blocks = iter(self.blocks)
+        for i, (spatial_block, temp_block) in enumerate(zip(blocks, blocks)):
+            pair_inputs = (spatial_block, temp_block, x, c,
+                           attention_mask_spatial, attention_mask_temproal,
+                           varlen_meta_spatial, varlen_meta_temproal, batches, i == 0)
             if self.gradient_checkpointing and self.training:
-                x = torch.utils.checkpoint.checkpoint(self.ckpt_wrapper(temp_block), x, c, attention_mask_temproal)
+                # one checkpoint per pair, the layout swap in between is recomputed along with the blocks
+                x = cp.checkpoint(self.block_pair_forward, *pair_inputs, use_reentrant=False)
             else:
-                x = temp_block(x, c, attention_mask_temproal)
-            x = rearrange(x, '(b t) f d -> (b f) t d', b=batches)
+                x = self.block_pair_forward(*pair_inputs)
 
-        if self.extras == 2:
-            c = timestep_spatial + y_spatial
-        else:
-            c = timestep_spatial
-        x = self.final_layer(x, c)               
+        x = self.final_layer(x, c_final)
         x = self.unpatchify(x)                  
-        x = rearrange(x, '(b f) c h w -> b f c h w', b=batches)
+        x = x.view(batches, frames, *x.shape[1:])  # (b f) c h w -> b f c h w
 
         return x
 
+    @torch.inference_mode()
+    def forward_graph(self, x, t, y=None, text_embedding=None):
+        """
+        Inference-only forward that records the whole forward pass into a CUDA graph the first time an
+        input shape / dtype is seen and replays it afterwards, so the many small per-block kernels are
+        launched without python overhead. Same inputs as forward, without attention_mask (the mask path
+        syncs with the host, which can't be captured). The returned tensor is the graph's static output,
+        it is overwritten by the next replay with the same shape, clone it if it must be kept.
+        At most max_cuda_graphs graphs are kept, moving or casting the model drops them.
+        """
+        assert x.is_cuda and not self.training, 'forward_graph is for cuda inference in eval mode'
+        inputs = (x, t, y, text_embedding)
+        caller_autocast = torch.is_autocast_enabled()
+        key = (x.device, self.bf16_autocast, caller_autocast, torch.get_autocast_gpu_dtype())
+        key += tuple((tuple(i.shape), i.dtype) if i is not None else None for i in inputs)
+        if key not in self.cuda_graphs:
+            if len(self.cuda_graphs) >= self.max_cuda_graphs:
+                # every graph pins its own memory pool, drop the oldest one
+                self.cuda_graphs.pop(next(iter(self.cuda_graphs)))
+            static_inputs = [i.clone() if i is not None else None for i in inputs]
+
+            def run():
+                # autocast's cast cache must be off while capturing, so (re)open it here instead of in forward
+                if caller_autocast:
+                    with torch.autocast(device_type='cuda', dtype=torch.get_autocast_gpu_dtype(), cache_enabled=False):
+                        return self.forward(*static_inputs[:2], y=static_inputs[2], text_embedding=static_inputs[3])
+                if self.bf16_autocast:
+                    with torch.autocast(device_type='cuda', dtype=torch.bfloat16, cache_enabled=False):
+                        return self.forward(*static_inputs[:2], y=static_inputs[2], text_embedding=static_inputs[3]).to(x.dtype)
+                return self.forward(*static_inputs[:2], y=static_inputs[2], text_embedding=static_inputs[3])
+
+            # warm up on a side stream before capturing (cublas workspaces, sdpa kernel selection)
+            stream = torch.cuda.Stream()
+            stream.wait_stream(torch.cuda.current_stream())
+            with torch.cuda.stream(stream):
+                for _ in range(2):
+                    run()
+            torch.cuda.current_stream().wait_stream(stream)
+
+            graph = torch.cuda.CUDAGraph()
+            with torch.cuda.graph(graph):
+                static_output = run()
+            self.cuda_graphs[key] = (graph, static_inputs, static_output)
+
+        graph, static_inputs, static_output = self.cuda_graphs[key]
+        for static_input, i in zip(static_inputs, inputs):
+            if i is not None:
+                static_input.copy_(i)
+        graph.replay()
+        return static_output
+
     def forward_with_cfg(self, x, t, y=None, cfg_scale=7.0, text_embedding=None, attention_mask=None):
         """
         Forward pass of Latte, but also batches the unconditional forward pass for classifier-free guidance.
@@ -665,144 +810,62 @@ class Latte(nn.Module):
         # For exact reproducibility reasons, we apply classifier-free guidance on only
         # three channels by default. The standard approach to cfg applies it to all channels.
         # This can be done by uncommenting the following line and commenting-out the line following that.
-        eps, rest = model_out[:, :self.in_channels], model_out[:, self.in_channels:]
-        # eps, rest = model_out[:, :3], model_out[:, 3:]
-        # eps, rest = model_out[:, :, :4, ...], model_out[:, :, 4:, ...]
+        # model_out is (N, F, C, H, W), the channels are on dim 2
+        eps = model_out[:, :, :self.in_channels]
+        # eps = model_out[:, :, :3]
+        # eps = model_out[:, :, :4, ...]
         cond_eps, uncond_eps = torch.split(eps, len(eps) // 2, dim=0)
         half_eps = uncond_eps + cfg_scale * (cond_eps - uncond_eps)
-        eps = torch.cat([half_eps, half_eps], dim=0) 
-        return torch.cat([eps, rest], dim=2)
-
-
-#################################################################################
-#                   Sine/Cosine Positional Embedding Functions                  #
-#################################################################################
-# https://github.com/facebookresearch/mae/blob/main/util/pos_embed.py
-
-def get_1d_sincos_temp_embed(embed_dim, length):
-    pos = torch.arange(0, length).unsqueeze(1)
-    return get_1d_sincos_pos_embed_from_grid(embed_dim, pos)
-
-def get_2d_sincos_pos_embed(embed_dim, grid_size, cls_token=False, extra_tokens=0):
-    """
-    grid_size: int of the grid height and width
-    return:
-    pos_embed: [grid_size*grid_size, embed_dim] or [1+grid_size*grid_size, embed_dim] (w/ or w/o cls_token)
-    """
-    grid_h = np.arange(grid_size, dtype=np.float32)
-    grid_w = np.arange(grid_size, dtype=np.float32)
-    grid = np.meshgrid(grid_w, grid_h)  # here w goes first
-    grid = np.stack(grid, axis=0)
-
-    grid = grid.reshape([2, 1, grid_size, grid_size])
-    pos_embed = get_2d_sincos_pos_embed_from_grid(embed_dim, grid)
-    if cls_token and extra_tokens > 0:
-        pos_embed = np.concatenate([np.zeros([extra_tokens, embed_dim]), pos_embed], axis=0)
-    return pos_embed
-
-
-def get_2d_sincos_pos_embed_from_grid(embed_dim, grid):
-    assert embed_dim % 2 == 0
-
-    # use half of dimensions to encode grid_h
-    emb_h = get_1d_sincos_pos_embed_from_grid(embed_dim // 2, grid[0]) 
-    emb_w = get_1d_sincos_pos_embed_from_grid(embed_dim // 2, grid[1]) 
-
-    emb = np.concatenate([emb_h, emb_w], axis=1)
-    return emb
-
-
-def get_1d_sincos_pos_embed_from_grid(embed_dim, pos):
-    """
-    embed_dim: output dimension for each position
-    pos: a list of positions to be encoded: size (M,)
-    out: (M, D)
-    """
-    assert embed_dim % 2 == 0
-    omega = np.arange(embed_dim // 2, dtype=np.float64)
-    omega /= embed_dim / 2.
-    omega = 1. / 10000**omega 
-
-    pos = pos.reshape(-1)  
-    out = np.einsum('m,d->md', pos, omega) 
-
-    emb_sin = np.sin(out) 
-    emb_cos = np.cos(out) 
-
-    emb = np.concatenate([emb_sin, emb_cos], axis=1) 
-    return emb
+        # model_out is ours, write the guided eps into both halves in place instead of
+        # concatenating a new eps and a new output, the remaining channels stay where they are.
+        # One broadcasting copy fills both halves
+        eps.unflatten(0, (2, -1)).copy_(half_eps)
+        return model_out
 
 
 #################################################################################
 #                                   Latte Configs                                  #
 #################################################################################
 
-from .configuration_latte import (
-    Latte_XL_122_Config, Latte_XL_144_Config, Latte_XL_188_Config,
-    Latte_L_122_Config, Latte_L_144_Config, Latte_L_188_Config,
-    Latte_B_122_Config, Latte_B_144_Config, Latte_B_188_Config,
-    Latte_S_122_Config, Latte_S_144_Config, Latte_S_188_Config,
-)
-
-def Latte_XL_122(**kwargs):
-    return Latte(Latte_XL_122_Config(**kwargs))
+from .configuration_latte import Latte_configs
 
-def Latte_XL_144(**kwargs):
-    return Latte(Latte_XL_144_Config(**kwargs))
 
-def Latte_XL_188(**kwargs):
-    return Latte(Latte_XL_188_Config(**kwargs))
+def build_latte(name, **kwargs):
+    return Latte(Latte_configs[name](**kwargs))
 
-def Latte_L_122(**kwargs):
-    return Latte(Latte_L_122_Config(**kwargs))
 
-def Latte_L_144(**kwargs):
-    return Latte(Latte_L_144_Config(**kwargs))
-
-def Latte_L_188(**kwargs):
-    return Latte(Latte_L_188_Config(**kwargs))
-
-def Latte_B_122(**kwargs):
-    return Latte(Latte_B_122_Config(**kwargs))
-
-def Latte_B_144(**kwargs):
-    return Latte(Latte_B_144_Config(**kwargs))
-
-def Latte_B_188(**kwargs):
-    return Latte(Latte_B_188_Config(**kwargs))
-
-def Latte_S_122(**kwargs):
-    return Latte(Latte_S_122_Config(**kwargs))
-
-def Latte_S_144(**kwargs):
-    return Latte(Latte_S_144_Config(**kwargs))
-
-def Latte_S_188(**kwargs):
-    return Latte(Latte_S_188_Config(**kwargs))
-
-
-Latte_models = {
-    "Latte-XL/122": Latte_XL_122, "Latte-XL/144": Latte_XL_144, "Latte-XL/188": Latte_XL_188,
-    "Latte-L/122": Latte_L_122, "Latte-L/144": Latte_L_144, "Latte-L/188": Latte_L_188,
-    "Latte-B/122": Latte_B_122, "Latte-B/144": Latte_B_144, "Latte-B/188": Latte_B_188,
-    "Latte-S/122": Latte_S_122, "Latte-S/144": Latte_S_144, "Latte-S/188": Latte_S_188,
-}
+Latte_models = {name: functools.partial(build_latte, name) for name in Latte_configs}
 
 
 if __name__ == '__main__':
 
     import torch
 
-    device = "cuda" if torch.cuda.is_available() else "cpu"
+    # a Latte-XL forward on cpu takes minutes, profile on a gpu
+    assert torch.cuda.is_available(), 'this profiling script needs a cuda device'
+    device = "cuda"
 
     img = torch.randn(3, 16, 4, 32, 32).to(device)
     t = torch.tensor([1, 2, 3]).to(device)
     y = torch.tensor([1, 2, 3]).to(device)
-    network = Latte_XL_122().to(device)
+    network = Latte_models["Latte-XL/122"]().to(device)
     from thop import profile 
     flops, params = profile(network, inputs=(img, t))
     print('FLOPs = ' + str(flops/1000**3) + 'G')
     print('Params = ' + str(params/1000**2) + 'M')
+
+    if hasattr(torch, 'compile'):
+        # thop counts the eager modules, time the compiled model separately
+        compiled = torch.compile(network, mode="reduce-overhead", fullgraph=False)
+        with torch.no_grad():
+            for _ in range(3):  # the first calls compile and record
+                compiled(img, t)
+            start, end = torch.cuda.Event(enable_timing=True), torch.cuda.Event(enable_timing=True)
+            start.record()
+            compiled(img, t)
+            end.record()
+        torch.cuda.synchronize()
+        print('Compiled forward = ' + str(start.elapsed_time(end)) + 'ms')
     # y_embeder = LabelEmbedder(num_classes=101, hidden_size=768, dropout_prob=0.5).to(device)
     # lora.mark_only_lora_as_trainable(network)
     # out = y_embeder(y, True)
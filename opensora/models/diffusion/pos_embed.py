@@ -0,0 +1,89 @@
+# Sine/Cosine positional embedding builders shared by the diffusion models.
+# References:
+# MAE: https://github.com/facebookresearch/mae/blob/main/util/pos_embed.py
+#
+# The public builders are lru_cached on all their arguments, device included, and return shared
+# tensors: callers must not modify them in place.
+import math
+import functools
+
+import torch
+
+
+_LOG_10000 = math.log(10000.)
+
+
+@functools.lru_cache(maxsize=16)
+def _arange_f32(n, device='cpu'):
+    # positions 0..n-1, shared between the builders. torch has no read-only flag, callers must not modify it
+    return torch.arange(n, dtype=torch.float32, device=device)
+
+
+@functools.lru_cache(maxsize=32)
+def get_1d_sincos_temp_embed(embed_dim, length, device='cpu', dtype=torch.float32):
+    """
+    return:
+    temp_embed: [length, embed_dim] on device in dtype
+    """
+    pos = _arange_f32(length, device)
+    return _sincos_1d(embed_dim, pos).to(dtype=dtype)
+
+
+@functools.lru_cache(maxsize=32)
+def get_2d_sincos_pos_embed(embed_dim, grid_size, cls_token=False, extra_tokens=0, device='cpu', dtype=torch.float32):
+    """
+    grid_size: int of the grid height and width
+    return:
+    pos_embed: [grid_size*grid_size, embed_dim] or [1+grid_size*grid_size, embed_dim] (w/ or w/o cls_token)
+    """
+    # the flattened (row-major) grid positions, here w goes first:
+    # w counts 0..grid_size-1 along every row, h holds the row index
+    pos = _arange_f32(grid_size, device)
+    grid = (pos.repeat(grid_size), pos.repeat_interleave(grid_size))
+    pos_embed = get_2d_sincos_pos_embed_from_grid(embed_dim, grid)
+    if cls_token and extra_tokens > 0:
+        pos_embed = torch.cat([pos_embed.new_zeros([extra_tokens, embed_dim]), pos_embed], dim=0)
+    return pos_embed.to(dtype=dtype)
+
+
+def get_2d_sincos_pos_embed_from_grid(embed_dim, grid):
+    assert embed_dim % 2 == 0
+
+    # use half of dimensions to encode grid_h
+    # both halves are written straight into their slices of emb, no concatenation
+    emb = grid[0].new_empty(grid[0].numel(), embed_dim)
+    # the two halves have the same width, so they share one frequency table
+    omega = _sincos_omega(embed_dim // 2, grid[0].device)
+    _sincos_1d(embed_dim // 2, grid[0], out=emb[:, :embed_dim // 2], omega=omega)
+    _sincos_1d(embed_dim // 2, grid[1], out=emb[:, embed_dim // 2:], omega=omega)
+    return emb
+
+
+def _sincos_omega(embed_dim, device):
+    # fp32 is plenty for these tables, which are stored in fp32 (or lower) anyway
+    omega = torch.arange(embed_dim // 2, dtype=torch.float32, device=device)
+    omega /= embed_dim / 2.
+    return torch.exp(omega * -_LOG_10000)  # 1 / 10000**omega
+
+
+def _sincos_1d(embed_dim, pos, out=None, omega=None):
+    """
+    The one sin-cos kernel behind both builders, the table is built on the device of pos.
+    embed_dim: output dimension for each position
+    pos: a list of positions to be encoded: size (M,)
+    out: optional (M, D) fp32 tensor (or view) to write the result into
+    omega: optional (D/2,) frequencies from _sincos_omega(embed_dim, pos.device)
+    return: (M, D)
+    """
+    assert embed_dim % 2 == 0
+    if omega is None:
+        omega = _sincos_omega(embed_dim, pos.device)
+
+    pos = pos.reshape(-1)  
+    angles = torch.outer(pos.to(omega.dtype), omega)  # (M, D/2)
+
+    # sin and cos write straight into the two halves of one buffer, no concatenation
+    emb = angles.new_empty(angles.shape[0], embed_dim) if out is None else out
+    torch.sin(angles, out=emb[:, :embed_dim // 2])
+    torch.cos(angles, out=emb[:, embed_dim // 2:])
+    return emb